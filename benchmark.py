@@ -1,40 +1,70 @@
 #!/usr/bin/env python
 
+import asyncio
+import collections
 import datetime
+import functools
+import itertools
 import json
 import logging
-import multiprocessing
 import os
-import queue
 import re
-import time
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
 import click
 import invoke
+import numpy as np
+import orjson
 import pandas as pd
+import uvloop
+from aiobotocore.config import AioConfig
+from aiobotocore.session import get_session
+from botocore.config import Config
 
 _TEMPLATE_FILE = 'template.yaml'
 _BUILD_DIR = '.aws-sam/build'
 _BUILT_TEMPLATE_FILE = os.path.join(_BUILD_DIR, 'template.yaml')
 _OUTPUT_TEMPLATE_FILE = os.path.join(_BUILD_DIR, 'packaged-template.yaml')
 
-_RATE_REGEX = r'^([0-9]+)\/([sm])$'
-_DURATION_REGEX = r'^([0-9]+)([sm])$'
+_RATE_REGEX = re.compile(r'^([0-9]+)\/([sm])$')
+_DURATION_REGEX = re.compile(r'^([0-9]+)([sm])$')
 
-_QUEUE_SIZE = 200
-_NUM_WORKERS = 20
+_MAX_CONCURRENT_INVOCATIONS = 200
+_MAX_INVOCATION_BATCH_SIZE = 10  # SNS and SQS accept at most 10 messages in a batch request
 _MAX_BATCH_SIZE = 5
+_XRAY_WORKERS = 16
+
+# names of the segments recorded by the pub/sub consumer functions
+_BENCHMARK_SEGMENT_NAMES = frozenset({'sns_benchmark', 'dynamodb_benchmark', 'sqs_benchmark', 'kinesis_benchmark'})
+
+# columns, and their types, of the segments dataframe
+_SEGMENT_SCHEMA = {'service': 'category', 'duration': 'float64', 'start_time': 'float64', 'end_time': 'float64'}
 
 _DEFAULT_STACK_NAME = 'pubsub-benchmark'
 _DEFAULT_MEMORY = 512
 _DEFAULT_SHARDS = 5
 _DEFAULT_DURATION = 300.0
 _DEFAULT_CALLS_PER_SECOND = 20.0
+_DEFAULT_INVOCATION_BATCH_SIZE = 1
 _DEFAULT_BENCHMARK_DISCARDED_PERCENT = 0.3
 
-cloudformation_client = boto3.client('cloudformation')
-xray_client = boto3.client('xray')
+
+# clients are created lazily, on first use, from a single shared session
+@functools.lru_cache(maxsize=None)
+def boto3_session():
+    return boto3.Session()
+
+
+@functools.lru_cache(maxsize=None)
+def cloudformation_client():
+    return boto3_session().client('cloudformation')
+
+
+@functools.lru_cache(maxsize=None)
+def xray_client():
+    # the X-Ray client is shared by all the threads fetching traces
+    return boto3_session().client('xray', config=Config(max_pool_connections=_XRAY_WORKERS))
 
 
 def setup_logging(debug):
@@ -47,33 +77,27 @@ def setup_logging(debug):
 
 
 def validate_rate(ctx, param, value):
-    if re.match(_RATE_REGEX, value) is None:
+    """Validate and parse a rate like 30/s or 30/m into a number of calls per second"""
+    m = _RATE_REGEX.match(value)
+    if m is None:
         raise click.BadParameter('rate need to be in format like 30/s')
-    return value
+    num, unit = float(m.group(1)), m.group(2)
+    return num / 60.0 if unit == 'm' else num
 
 
 def validate_duration(ctx, param, value):
-    if re.match(_DURATION_REGEX, value) is None:
+    """Validate and parse a duration like 30s or 5m into a number of seconds"""
+    m = _DURATION_REGEX.match(value)
+    if m is None:
         raise click.BadParameter('duration need to be in format like 30s')
-    return value
+    num, unit = float(m.group(1)), m.group(2)
+    return num * 60.0 if unit == 'm' else num
 
 
 def validate_memory(ctx, param, value):
     return int(value)
 
 
-def parse_rate(rate):
-    m = re.match(_RATE_REGEX, rate)
-    num, unit = float(m.group(1)), m.group(2)
-    return num / 60.0 if unit == 'm' else num
-
-
-def parse_duration(duration):
-    m = re.match(_DURATION_REGEX, duration)
-    num, unit = float(m.group(1)), m.group(2)
-    return num * 60.0 if unit == 'm' else num
-
-
 def create_requirements_file():
     logging.info('Creating functions requirements file')
     invoke.run('pipenv lock -r > functions/requirements.txt')
@@ -108,97 +132,59 @@ def wait_for_stack_deletion(stack_name=_DEFAULT_STACK_NAME):
 
 
 def get_function_name(stack_name=_DEFAULT_STACK_NAME):
-    response = cloudformation_client.describe_stacks(StackName=stack_name)
+    response = cloudformation_client().describe_stacks(StackName=stack_name)
     return response['Stacks'][0]['Outputs'][0]['OutputValue']
 
 
-class Throttler(multiprocessing.Process):
-    """
-    Throttler submits messages to a queue at a given rate.
-    """
-    def __init__(self, rate_queue, interval):
-        super().__init__()
-        self.exit = multiprocessing.Event()
-        self.rate_queue = rate_queue
-        self.interval = interval
-
-    def run(self):
-        try:
-            while not self.exit.is_set():
-                if not self.rate_queue.full():  # avoid blocking
-                    self.rate_queue.put(0)
-                time.sleep(self.interval)
-        except BrokenPipeError:
-            # main process is done
-            return
-
-    def shutdown(self):
-        logging.debug(f'Throttler shutting down')
-        self.exit.set()
-
-
-class Worker(multiprocessing.Process):
-    """
-    A worker pull messages from a queue and invoke the fan out lambda function
-    defined in the template at every message. It will block if the queue is empty.
-    """
-    def __init__(self, worker_id, rate_queue, function_name):
-        super().__init__()
-        self.exit = multiprocessing.Event()
-        self.id = worker_id
-        self.rate_queue = rate_queue
-        self.function_name = function_name
-        self.invocations = 0
-
-    def run(self):
-        lambda_client = boto3.client('lambda')
-        while not self.exit.is_set():
-            try:
-                self.rate_queue.get(timeout=0.01)
-                logging.debug(f'Worker [{self.id}] invoking lambda')
-                lambda_client.invoke(FunctionName=self.function_name, InvocationType='Event')
-                self.invocations += 1
-            except queue.Empty:
-                continue
-
-    def shutdown(self):
-        logging.debug(f'Worker [{self.id}] shutting down')
-        self.exit.set()
-
-
-def run_benchmark(rate=_DEFAULT_CALLS_PER_SECOND, duration=_DEFAULT_DURATION, stack_name=_DEFAULT_STACK_NAME):
+async def run_benchmark(rate=_DEFAULT_CALLS_PER_SECOND, duration=_DEFAULT_DURATION,
+                        batch_size=_DEFAULT_INVOCATION_BATCH_SIZE, stack_name=_DEFAULT_STACK_NAME):
     """
     Run the benchmark by invoking the fan out lambda function
     at the given rate until the duration time of the benchmark is reached.
+    Invocations are issued concurrently from a single event loop, bounded
+    by the maximum number of in flight invocations. Each invocation carries
+    a batch of messages, so the function is invoked batch_size times less
+    often than the message rate.
     """
     function_name = get_function_name(stack_name=stack_name)
-    logging.info(f'Submitting messages with rate [{rate}] for [{duration}]')
-    rate, duration = parse_rate(rate), parse_duration(duration)
-    rate_queue = multiprocessing.Manager().Queue(maxsize=_QUEUE_SIZE)
-
-    throttler = Throttler(rate_queue, 1.0 / rate)
-    workers = [Worker(str(i), rate_queue, function_name) for i in range(_NUM_WORKERS)]
-
-    # start throttler and workers
-    throttler.start()
-    for p in workers:
-        p.start()
+    logging.info(f'Submitting messages with rate [{rate}/s] in batches of [{batch_size}] for [{duration}s]')
+    interval = batch_size / rate
+    semaphore = asyncio.Semaphore(_MAX_CONCURRENT_INVOCATIONS)
+    invocations = 0
 
-    # wait for the required duration
-    start_time = time.time()
-    while (time.time() - start_time) <= duration:
-        time.sleep(1)
-        logging.info(f'Elapsed time {time.time() - start_time}')
-
-    # stop workers and wait for them to finish
-    for w in workers:
-        w.shutdown()
-    for w in workers:
-        w.join()
-    throttler.shutdown()
-
-    total_invocations = sum([w.invocations for w in workers])
-    logging.info(f'Run {total_invocations} in {duration} seconds')
+    async def invoke_function(lambda_client):
+        nonlocal invocations
+        try:
+            logging.debug(f'Invoking lambda with a batch of [{batch_size}] messages')
+            await lambda_client.invoke(FunctionName=function_name, InvocationType='Event',
+                                       Payload=json.dumps({'batch_size': batch_size}))
+            invocations += 1
+        except Exception as e:
+            logging.warning(f'Lambda invocation failed: {e}')
+        finally:
+            semaphore.release()
+
+    config = AioConfig(max_pool_connections=_MAX_CONCURRENT_INVOCATIONS)
+    async with get_session().create_client('lambda', config=config) as lambda_client:
+        loop = asyncio.get_running_loop()
+        tasks = set()
+        start_time = next_at = last_logged = loop.time()
+        while (next_at - start_time) <= duration:
+            await asyncio.sleep(max(0.0, next_at - loop.time()))
+            await semaphore.acquire()
+            task = asyncio.create_task(invoke_function(lambda_client))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            next_at += interval
+
+            if loop.time() - last_logged >= 1.0:
+                last_logged = loop.time()
+                logging.info(f'Elapsed time {last_logged - start_time}')
+
+        # wait for in flight invocations to finish
+        await asyncio.gather(*tasks)
+
+    logging.info(f'Run {invocations} invocations with {invocations * batch_size} messages in {duration} seconds')
 
 
 def get_traces_time_interval(duration=_DEFAULT_DURATION, discarded=_DEFAULT_BENCHMARK_DISCARDED_PERCENT):
@@ -214,63 +200,82 @@ def get_traces_time_interval(duration=_DEFAULT_DURATION, discarded=_DEFAULT_BENC
 
 
 def get_trace_ids(start_time, end_time):
-    """Fetch the ids of all the X-Ray traces between start time and end time"""
-    trace_ids = []
-    for p in xray_client.get_paginator('get_trace_summaries')\
+    """Lazily fetch the ids of all the X-Ray traces between start time and end time"""
+    for p in xray_client().get_paginator('get_trace_summaries')\
             .paginate(StartTime=start_time, EndTime=end_time, FilterExpression='annotation.scope = "benchmark"'):
-        trace_ids.extend([t['Id'] for t in p['TraceSummaries']])
-    return trace_ids
+        yield from (t['Id'] for t in p['TraceSummaries'])
 
 
-def chunks(l, n):
-    """Divide the list l into chunks of at most n elements"""
-    for i in range(0, len(l), n):
-        yield l[i:i + n]
+def chunks(iterable, n):
+    """Divide the iterable into chunks of at most n elements"""
+    iterator = iter(iterable)
+    chunk = list(itertools.islice(iterator, n))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(iterator, n))
 
 
-def get_segments(trace_ids):
+def get_traces(trace_ids):
     """
-    Fetch the complete segments information for the given trace IDs filtering
-    the ones containing benchmark in their name as the relevant ones for this application.
+    Fetch the complete traces for the given trace IDs. Batches of traces are
+    fetched concurrently as soon as their IDs are available, keeping a bounded
+    number of batches in flight.
     """
-    def compute_duration(segment):
-        segment['duration'] = segment['end_time'] - segment['start_time']
-        return segment
-
-    def unpack_annotations(segment):
-        segment.update(segment['annotations'])
-        segment.pop('annotations')
-        return segment
-
-    segments = {}
-    for ids in chunks(trace_ids, _MAX_BATCH_SIZE):
-        traces = xray_client.batch_get_traces(TraceIds=ids)['Traces']
-        segments.update({t['Id'] + s['Id']: s for t in traces for s in t['Segments']})
-    segments = [json.loads(v['Document']) for v in segments.values()]
-    segments = [v for v in segments if '_benchmark' in v['name']]
-    segments = [compute_duration(s) for s in segments]
-    segments = [unpack_annotations(s) for s in segments]
-    return segments
+    client = xray_client()
 
+    def batch_get_traces(ids):
+        return client.batch_get_traces(TraceIds=ids)['Traces']
 
-def get_dataframe(segments):
+    with ThreadPoolExecutor(max_workers=_XRAY_WORKERS) as executor:
+        pending = collections.deque()
+        for ids in chunks(trace_ids, _MAX_BATCH_SIZE):
+            pending.append(executor.submit(batch_get_traces, ids))
+            if len(pending) >= 2 * _XRAY_WORKERS:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def get_segments(trace_ids):
     """
-    Create a pandas dataframe from a list of segments
-    filtering out all segments with a negative duration
+    Fetch the complete segments information for the given trace IDs keeping
+    the ones recorded by the benchmark consumers as the relevant ones for this application.
+    Segments are returned as columns, keyed by the names in the segment schema.
     """
-    df = pd.DataFrame(segments)
-    return df[df['duration'] > 0]
+    seen = set()
+    services, start_times, end_times = [], [], []
+    for t in get_traces(trace_ids):
+        for s in t['Segments']:
+            # cheap check on the raw document to avoid parsing segments not relevant for the benchmark
+            if '_benchmark' not in s['Document'] or (t['Id'], s['Id']) in seen:
+                continue
+            seen.add((t['Id'], s['Id']))
+            segment = orjson.loads(s['Document'])
+            # segments with a non-positive duration are discarded
+            if segment['name'] not in _BENCHMARK_SEGMENT_NAMES or segment['end_time'] <= segment['start_time']:
+                continue
+            services.append(segment['annotations']['service'])
+            start_times.append(segment['start_time'])
+            end_times.append(segment['end_time'])
+
+    start_times = np.asarray(start_times, dtype=np.float64)
+    end_times = np.asarray(end_times, dtype=np.float64)
+    return {'service': services, 'duration': np.subtract(end_times, start_times),
+            'start_time': start_times, 'end_time': end_times}
+
+
+def get_dataframe(segments):
+    """Create a pandas dataframe from the columns of segments"""
+    return pd.DataFrame(segments, columns=list(_SEGMENT_SCHEMA)).astype(_SEGMENT_SCHEMA)
 
 
 def compute_service_stats(df):
     """Compute relevant latency statistics by pub/sub system"""
-    def compute(group):
-        return {'count': int(group.count()), 'mean': group.mean(), 'p50': group.median(),
-                'p75': group.quantile(q=0.75), 'p90': group.quantile(q=0.90), 'p95': group.quantile(q=0.95)}
-
-    stats = df['duration'].groupby(df['service']).apply(compute).unstack()
-    stats.loc[:, stats.columns != 'count'] = stats.loc[:, stats.columns != 'count'] * 1000.0
-    stats['count'] = stats['count'].astype('int')
+    durations = df['duration'].groupby(df['service'], observed=True)
+    quantiles = durations.quantile([0.5, 0.75, 0.9, 0.95]).unstack()
+    quantiles.columns = ['p50', 'p75', 'p90', 'p95']
+    stats = durations.agg(['count', 'mean']).join(quantiles)
+    stats.iloc[:, 1:] *= 1000.0
     return stats
 
 
@@ -280,7 +285,6 @@ def get_stats(duration=_DEFAULT_DURATION, discarded=_DEFAULT_BENCHMARK_DISCARDED
     various pub/sub systems after the benchmark has run
     """
     logging.info(f'Gathering benchmark results')
-    duration = parse_duration(duration)
     start_time, end_time = get_traces_time_interval(duration=duration, discarded=discarded)
     trace_ids = get_trace_ids(start_time, end_time)
     segments = get_segments(trace_ids)
@@ -300,10 +304,13 @@ def get_stats(duration=_DEFAULT_DURATION, discarded=_DEFAULT_BENCHMARK_DISCARDED
               callback=validate_rate, help='Rate of messages delivered to the pub sub queues')
 @click.option('--duration', type=click.STRING, default=f'{int(_DEFAULT_DURATION)}s', show_default=True,
               callback=validate_duration, help='Duration of the benchmark')
+@click.option('--batch-size', type=click.IntRange(min=1, max=_MAX_INVOCATION_BATCH_SIZE),
+              default=_DEFAULT_INVOCATION_BATCH_SIZE, show_default=True,
+              help='Number of messages sent by each invocation of the fan out lambda function')
 @click.option('--discarded', type=click.FLOAT, default=_DEFAULT_BENCHMARK_DISCARDED_PERCENT, show_default=True,
               help='Percentage, between 0 and 1, of traces to be discarded from the beginning of the benchmark')
 @click.option('--debug/--no-debug', default=False)
-def cli(bucket, shards, memory, stack_name, rate, duration, discarded, debug):
+def cli(bucket, shards, memory, stack_name, rate, duration, batch_size, discarded, debug):
     """
     Run a benchmark measuring the latency of various pub/sub and messaging systems in AWS.
 
@@ -313,12 +320,13 @@ def cli(bucket, shards, memory, stack_name, rate, duration, discarded, debug):
     this services. It will finally destroy the CloudFormation stack leaving no dangling resources.
     """
     setup_logging(debug)
+    uvloop.install()
     create_requirements_file()
     build_lambda_functions()
     package_lambda_function(bucket)
     deploy_lambda_functions(shards=shards, memory=memory, stack_name=stack_name)
 
-    run_benchmark(rate, duration=duration, stack_name=stack_name)
+    asyncio.run(run_benchmark(rate, duration=duration, batch_size=batch_size, stack_name=stack_name))
     stats = get_stats(duration=duration, discarded=discarded)
     logging.info(f'Latency statistics -- AWS Lambda memory [{memory}] -- Kinesis shards [{shards}]')
     print(stats)
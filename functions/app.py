@@ -1,60 +1,146 @@
 import base64
-import json
 import os
 import time
-import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
+import orjson
 from aws_xray_sdk.core import patch, xray_recorder
 from aws_xray_sdk.core.models.segment import Segment
 
+# retries of the entries failed in a batch request
+_MAX_SEND_ATTEMPTS = 5
+_RETRY_BASE_DELAY = 0.05
 
 patch(('boto3',))
 xray_client = boto3.client('xray')
+sns_client = boto3.client('sns')
+dynamodb_client = boto3.client('dynamodb')
+sqs_client = boto3.client('sqs')
+kinesis_client = boto3.client('kinesis')
+executor = ThreadPoolExecutor(max_workers=4)
 
 
 def fanout_handler(event, _):
-    print(f'Event:\n{json.dumps(event)}')
-    current_segment = xray_recorder.current_segment()
-
-    sns_client = boto3.client('sns')
-    sns_client.publish(
-        TopicArn=os.getenv('TOPIC_ARN'),
-        Message=json.dumps({'default': json.dumps({'start_time': time.time(),
-                                                   'trace_id': current_segment.trace_id,
-                                                   'id': current_segment.id})}),
-        MessageStructure='json'
+    """
+    Propagate a batch of messages through every pub/sub system, the number of
+    messages is given by the batch_size of the event and defaults to one.
+    Each pub/sub system receives the whole batch with a single call and the
+    systems are called concurrently, so that the latency of the fan out is the
+    one of the slowest system instead of the sum.
+    All the messages in the batch share the start time of the invocation.
+    """
+    start_time = time.time()
+    print(f'Event:\n{orjson.dumps(event).decode()}')
+    with xray_recorder.in_subsegment('fanout') as fanout_segment:
+        parent = xray_recorder.current_segment()
+        messages = [new_message(parent, start_time) for _ in range(event.get('batch_size', 1))]
+        bodies = [orjson.dumps(m) for m in messages]
+        futures = [executor.submit(traced, fanout_segment, publish, messages, bodies)
+                   for publish in (publish_sns, put_dynamodb, send_sqs, put_kinesis)]
+        for future in futures:
+            future.result()
+
+
+def new_message(parent, start_time):
+    """
+    Create a message with a random id, used as the DynamoDB key. The id does not
+    depend on X-Ray sampling: unsampled subsegments all share the same dummy id.
+    The consumer segments are recorded as children of the given parent segment.
+    """
+    return {'start_time': start_time, 'trace_id': parent.trace_id, 'parent_id': parent.id, 'id': os.urandom(8).hex()}
+
+
+def traced(entity, func, *args):
+    """Run the function in a pool thread recording its X-Ray subsegments under the given entity"""
+    xray_recorder.set_trace_entity(entity)
+    return func(*args)
+
+
+def send_with_retries(service, send, to_entries, failed, messages, bodies):
+    """
+    Send the messages with the given batch call, retrying the messages reported
+    as failed with an exponential backoff. Retried messages get a new start time,
+    so that the backoff is not measured as delivery latency. Raise if some
+    messages still fail after the last attempt instead of silently dropping them.
+    """
+    for attempt in range(_MAX_SEND_ATTEMPTS):
+        if attempt > 0:
+            print(f'{service} retrying {len(messages)} failed messages')
+            time.sleep(_RETRY_BASE_DELAY * 2 ** (attempt - 1))
+            start_time = time.time()
+            messages = [dict(m, start_time=start_time) for m in messages]
+            bodies = [orjson.dumps(m) for m in messages]
+        entries = to_entries(messages, bodies)
+        failed_indexes = failed(entries, send(entries))
+        if not failed_indexes:
+            return
+        messages = [messages[i] for i in failed_indexes]
+    raise RuntimeError(f'{service} failed to send {len(messages)} messages after {_MAX_SEND_ATTEMPTS} attempts')
+
+
+def failed_by_id(_, response):
+    """Indexes of the entries in the Failed list of an SNS or SQS batch response"""
+    return [int(f['Id']) for f in response.get('Failed', [])]
+
+
+def publish_sns(messages, bodies):
+    send_with_retries(
+        'SNS',
+        lambda entries: sns_client.publish_batch(TopicArn=os.getenv('TOPIC_ARN'), PublishBatchRequestEntries=entries),
+        lambda _, bodies: [
+            {'Id': str(i), 'Message': orjson.dumps({'default': b.decode()}).decode(), 'MessageStructure': 'json'}
+            for i, b in enumerate(bodies)
+        ],
+        failed_by_id,
+        messages, bodies
     )
 
-    dynamodb_client = boto3.client('dynamodb')
-    dynamodb_client.put_item(
-        TableName=os.getenv('TABLE_NAME'),
-        Item={
-            'id': {'S': current_segment.id},
-            'start_time': {'N': str(time.time())},
-            'trace_id': {'S': current_segment.trace_id}
-        }
+
+def put_dynamodb(messages, bodies):
+    table_name = os.getenv('TABLE_NAME')
+
+    def unprocessed(entries, response):
+        ids = {e['PutRequest']['Item']['id']['S'] for e in response.get('UnprocessedItems', {}).get(table_name, [])}
+        return [i for i, e in enumerate(entries) if e['PutRequest']['Item']['id']['S'] in ids]
+
+    send_with_retries(
+        'DynamoDB',
+        lambda entries: dynamodb_client.batch_write_item(RequestItems={table_name: entries}),
+        lambda messages, _: [{'PutRequest': {'Item': {
+            'id': {'S': m['id']},
+            'start_time': {'N': str(m['start_time'])},
+            'trace_id': {'S': m['trace_id']},
+            'parent_id': {'S': m['parent_id']}
+        }}} for m in messages],
+        unprocessed,
+        messages, bodies
     )
 
-    sqs_client = boto3.client('sqs')
-    sqs_client.send_message(
-        QueueUrl=os.getenv('QUEUE_URL'),
-        MessageBody=json.dumps({'start_time': time.time(), 'trace_id': current_segment.trace_id,
-                                'id': current_segment.id})
+
+def send_sqs(messages, bodies):
+    send_with_retries(
+        'SQS',
+        lambda entries: sqs_client.send_message_batch(QueueUrl=os.getenv('QUEUE_URL'), Entries=entries),
+        lambda _, bodies: [{'Id': str(i), 'MessageBody': b.decode()} for i, b in enumerate(bodies)],
+        failed_by_id,
+        messages, bodies
     )
 
-    kinesis_client = boto3.client('kinesis')
-    kinesis_client.put_record(
-        StreamName=os.getenv('STREAM_NAME'),
-        Data=json.dumps({'start_time': time.time(), 'trace_id': current_segment.trace_id,
-                         'id': current_segment.id}),
-        PartitionKey=str(uuid.uuid4())
-        )
+
+def put_kinesis(messages, bodies):
+    send_with_retries(
+        'Kinesis',
+        lambda entries: kinesis_client.put_records(StreamName=os.getenv('STREAM_NAME'), Records=entries),
+        lambda _, bodies: [{'Data': b, 'PartitionKey': os.urandom(8).hex()} for b in bodies],
+        lambda _, response: [i for i, r in enumerate(response.get('Records', [])) if 'ErrorCode' in r],
+        messages, bodies
+    )
 
 
 def sns_handler(event, _):
-    message = json.loads(event['Records'][0]['Sns']['Message'])
-    segment = Segment('sns_benchmark', traceid=message['trace_id'], parent_id=message['id'], sampled=True)
+    message = orjson.loads(event['Records'][0]['Sns']['Message'])
+    segment = Segment('sns_benchmark', traceid=message['trace_id'], parent_id=message['parent_id'], sampled=True)
     segment.start_time = message['start_time']
     segment.put_annotation('scope', 'benchmark')
     segment.put_annotation('service', 'sns')
@@ -64,7 +150,8 @@ def sns_handler(event, _):
 
 def dynamodb_handler(event, _):
     message = event['Records'][0]['dynamodb']['NewImage']
-    segment = Segment('dynamodb_benchmark', traceid=message['trace_id']['S'], parent_id=message['id']['S'], sampled=True)
+    segment = Segment('dynamodb_benchmark', traceid=message['trace_id']['S'], parent_id=message['parent_id']['S'],
+                      sampled=True)
     segment.start_time = float(message['start_time']['N'])
     segment.put_annotation('scope', 'benchmark')
     segment.put_annotation('service', 'dynamodb')
@@ -73,8 +160,8 @@ def dynamodb_handler(event, _):
 
 
 def sqs_handler(event, _):
-    message = json.loads(event['Records'][0]['body'])
-    segment = Segment('sqs_benchmark', traceid=message['trace_id'], parent_id=message['id'], sampled=True)
+    message = orjson.loads(event['Records'][0]['body'])
+    segment = Segment('sqs_benchmark', traceid=message['trace_id'], parent_id=message['parent_id'], sampled=True)
     segment.start_time = message['start_time']
     segment.put_annotation('scope', 'benchmark')
     segment.put_annotation('service', 'sqs')
@@ -83,8 +170,8 @@ def sqs_handler(event, _):
 
 
 def kinesis_handler(event, _):
-    message = json.loads(base64.b64decode(event['Records'][0]['kinesis']['data']))
-    segment = Segment('kinesis_benchmark', traceid=message['trace_id'], parent_id=message['id'], sampled=True)
+    message = orjson.loads(base64.b64decode(event['Records'][0]['kinesis']['data']))
+    segment = Segment('kinesis_benchmark', traceid=message['trace_id'], parent_id=message['parent_id'], sampled=True)
     segment.start_time = message['start_time']
     segment.put_annotation('scope', 'benchmark')
     segment.put_annotation('service', 'kinesis')